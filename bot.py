@@ -1,17 +1,21 @@
 import os
 import re
 import json
-import time
 import asyncio
 import logging
+import threading
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Dict, FrozenSet, Optional, Tuple
 
 from dotenv import load_dotenv
 
 from telegram import (
     Update,
+    Voice,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ReplyKeyboardMarkup,
@@ -20,6 +24,7 @@ from telegram import (
 )
 from telegram.constants import ChatAction
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     ApplicationBuilder,
     CommandHandler,
@@ -29,15 +34,16 @@ from telegram.ext import (
     filters,
 )
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 """
 This version of the bot implements several improvements based on user feedback:
 
 1. **Persistent reply keyboard** – after every response the menu buttons stay
-   visible instead of being removed.  This is achieved by sending the
-   appropriate reply keyboard with every message rather than using
-   `ReplyKeyboardRemove()`.
+   visible instead of being removed.  The keyboard is marked `is_persistent`
+   and is still attached to every reply, so chats holding an older one-time
+   keyboard get it back as well.
 2. **Multilingual golden answers** – the five base questions now have
    pre‑defined answers not only in Russian but also in Ukrainian, English
    and French.  These deterministic answers are used whenever the user
@@ -47,9 +53,9 @@ This version of the bot implements several improvements based on user feedback:
    URLs or excessive repeated characters are treated as spam.  The bot
    politely asks the user to choose a menu item or rephrase instead of
    forwarding such messages to the assistant.
-4. **Refined voice handling** – after processing a voice message, the
-   bot always sends the reply keyboard again so that the user can
-   continue the conversation smoothly.
+4. **Refined voice handling** – voice messages are acknowledged right
+   away, transcribed and then answered like text, and the reply keyboard
+   is sent again so that the user can continue the conversation smoothly.
 
 The rest of the logic (state management, assistant integration, etc.)
 remains largely unchanged from the original implementation.
@@ -70,14 +76,42 @@ PRESENTATION_FILE_ID = os.getenv("PRESENTATION_FILE_ID", "").strip()  # Telegram
 VERIFY_MODEL = os.getenv("VERIFY_MODEL", "gpt-4o-mini").strip()
 TRANSCRIBE_MODEL = os.getenv("TRANSCRIBE_MODEL", "whisper-1").strip()
 
+# Webhook mode (optional): set WEBHOOK_URL to the public https base URL; empty -> long polling.
+# WEBHOOK_SECRET is then required: Telegram echoes it in a header and updates without it are rejected.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("TELEGRAM_BOT_TOKEN (or TELEGRAM_TOKEN) missing")
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY missing")
 if not ASSISTANT_ID:
     raise RuntimeError("ASSISTANT_ID missing")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET missing (required when WEBHOOK_URL is set)")
+
+_client: Optional[AsyncOpenAI] = None
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+def get_client() -> AsyncOpenAI:
+    """
+    The one OpenAI client for every call (threads, runs, STT), created on first
+    use so boot and API-free paths (/status, menu buttons, GOLD answers) don't
+    pay for the TLS context and pool. Its pool is sized for many users' streamed
+    runs, thread creation and transcriptions at once, and HTTP/2 multiplexes
+    those requests over a few kept-alive TLS connections. Closed in post_shutdown().
+    """
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            ),
+        )
+    return _client
 
 
 # =========================
@@ -131,48 +165,101 @@ def acquire_single_instance_lock() -> None:
 STATE_FILE = Path("maisonbot_state.json")
 
 
-@dataclass
+@dataclass(slots=True)
 class UserState:
     lang: str = "RU"       # UA/RU/EN/FR
     thread_id: str = ""    # per-user shared thread
 
 
 _state: Dict[str, UserState] = {}
-_blocked = set()
-_user_locks: Dict[str, asyncio.Lock] = {}
+_blocked: FrozenSet[str] = frozenset()  # read-only at runtime; replaced wholesale on load
+# Weak values: a lock lives only while some handler holds or awaits it, so
+# these maps stay as small as the set of currently busy users.
+_user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+_thread_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
 
 
 def load_state() -> None:
     global _state, _blocked
     if not STATE_FILE.exists():
         _state = {}
-        _blocked = set()
+        _blocked = frozenset()
         return
     raw = json.loads(STATE_FILE.read_text(encoding="utf-8"))
-    _blocked = set(raw.get("blocked", []))
+    _blocked = frozenset(raw.get("blocked", []))
     users = raw.get("users", {})
     _state = {uid: UserState(**users[uid]) for uid in users}
 
 
-def save_state() -> None:
+def _dump_state() -> str:
     raw = {
         "blocked": sorted(_blocked),
         "users": {uid: {"lang": s.lang, "thread_id": s.thread_id} for uid, s in _state.items()},
     }
-    STATE_FILE.write_text(json.dumps(raw, ensure_ascii=False, indent=2), encoding="utf-8")
+    return json.dumps(raw, ensure_ascii=False, indent=2)
+
+
+# Held by the writing thread itself: cancelling state_writer() does not stop a
+# write already running in to_thread(), so the shutdown flush must wait for it.
+_state_file_lock = threading.Lock()
+
+
+def _write_state(data: str) -> None:
+    # write + rename so a crash mid-write never leaves a truncated state file
+    tmp = STATE_FILE.with_suffix(".tmp")
+    with _state_file_lock:
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, STATE_FILE)
+
+
+def save_state() -> None:
+    _write_state(_dump_state())
+
+
+SAVE_DEBOUNCE_SEC = 0.5
+
+_save_requested = asyncio.Event()
+_state_writer_task: Optional[asyncio.Task] = None
+
+
+def schedule_save() -> None:
+    """Mark state as changed; state_writer() persists it within SAVE_DEBOUNCE_SEC."""
+    _save_requested.set()
+
+
+async def state_writer() -> None:
+    """
+    Background task: coalesces all schedule_save() calls made within one
+    debounce window into a single file write, done off the event loop.
+    """
+    while True:
+        await _save_requested.wait()
+        await asyncio.sleep(SAVE_DEBOUNCE_SEC)
+        _save_requested.clear()
+        try:
+            # snapshot on the loop thread, write in the executor
+            await asyncio.to_thread(_write_state, _dump_state())
+        except Exception as e:
+            log.warning("State save failed: %s", e)
+            _save_requested.set()
 
 
 def get_user(user_id: str) -> UserState:
     if user_id not in _state:
         _state[user_id] = UserState()
-        save_state()
+        schedule_save()
     return _state[user_id]
 
 
+def _lock_for(locks: "weakref.WeakValueDictionary[str, asyncio.Lock]", key: str) -> asyncio.Lock:
+    lock = locks.get(key)
+    if lock is None:
+        lock = locks[key] = asyncio.Lock()
+    return lock
+
+
 def get_user_lock(user_id: str) -> asyncio.Lock:
-    if user_id not in _user_locks:
-        _user_locks[user_id] = asyncio.Lock()
-    return _user_locks[user_id]
+    return _lock_for(_user_locks, user_id)
 
 
 LANGS = ["UA", "RU", "EN", "FR"]
@@ -231,6 +318,76 @@ CONTACTS_TEXT = {
     "FR": "Contacts Maison de Café:\n• Email : maisondecafe.coffee@gmail.com\n• Téléphone : +32 470 600 806\n• Telegram : https://t.me/maisondecafe",
 }
 
+# Fixed UI replies: TRANSLATIONS[key][lang], read through ui_text()
+TRANSLATIONS: Dict[str, Dict[str, str]] = {
+    "start": {
+        "UA": "Привіт! Я Max, консультант Maison de Café. Оберіть пункт меню — і я підкажу по суті.",
+        "RU": "Привет! Я Max, консультант Maison de Café. Выберите пункт меню — и я подскажу по сути.",
+        "EN": "Hi! I’m Max, Maison de Café consultant. Choose a menu item and I’ll guide you.",
+        "FR": "Bonjour ! Je suis Max, consultant Maison de Café. Choisissez un пункт du menu et je vous guide.",
+    },
+    "lang_prompt": {
+        "UA": "Оберіть мову:",
+        "RU": "Выберите язык:",
+        "EN": "Choose language:",
+        "FR": "Choisissez la langue:",
+    },
+    "lang_changed": {
+        "UA": "Мову змінено.",
+        "RU": "Язык изменён.",
+        "EN": "Language updated.",
+        "FR": "Langue mise à jour.",
+    },
+    "spam_reply": {
+        "UA": "Вибачте, не зрозумів запит. Оберіть пункт меню або поставте уточнювальне питання.",
+        "RU": "Извините, не понял запрос. Выберите пункт меню или уточните вопрос.",
+        "EN": "Sorry, I didn’t understand. Please choose a menu item or clarify.",
+        "FR": "Désolé, je n’ai pas compris. Choisissez un élément du menu ou clarifiez.",
+    },
+    "presentation_missing": {
+        "UA": "Гарне запитання. Презентація ще не підключена — додамо файл і я одразу зможу її надіслати.",
+        "RU": "Хороший вопрос. Презентация ещё не подключена — добавим файл и я сразу смогу её отправить.",
+        "EN": "Good question. The presentation isn’t connected yet — once the file is added, I can send it right away.",
+        "FR": "Bonne question. La présentation n’est pas encore connectée — dès que le fichier est ajouté, je peux l’envoyer.",
+    },
+    "presentation_failed": {
+        "UA": "Гарне запитання. Не зміг відправити презентацію в цьому чаті. Напишіть — і я надішлю іншим способом.",
+        "RU": "Хороший вопрос. Не получилось отправить презентацию в этом чате. Напишите — и я пришлю другим способом.",
+        "EN": "Good question. I couldn’t send the presentation here. Message me and I’ll share it another way.",
+        "FR": "Bonne question. Je n’arrive pas à envoyer la présentation ici. Écrivez-moi et je la partagerai autrement.",
+    },
+    "voice_failed": {
+        "UA": "Гарне запитання. Не зміг розпізнати голос. Спробуйте ще раз коротше й чіткіше.",
+        "RU": "Хороший вопрос. Не смог распознать голос. Попробуйте ещё раз короче и чётче.",
+        "EN": "Good question. I couldn’t transcribe the voice message. Please try again, shorter and clearer.",
+        "FR": "Bonne question. Je n’ai pas pu transcrire le message vocal. Réessayez plus court et plus clair.",
+    },
+    "voice_ack": {
+        "UA": "🎙 Розпізнаю…",
+        "RU": "🎙 Распознаю…",
+        "EN": "🎙 Transcribing…",
+        "FR": "🎙 Transcription…",
+    },
+    "kb_fallback": {
+        "UA": "Я не можу відповісти коректно по базі. Оберіть пункт меню або уточніть питання.",
+        "RU": "Я не могу ответить корректно по базе. Выберите пункт меню или уточните вопрос.",
+        "EN": "I can’t answer correctly from the knowledge base. Please choose a menu item or уточните вопрос.",
+        "FR": "Je ne peux pas répondre correctement selon la base. Choisissez un пункт du menu ou уточните вопрос.",
+    },
+    "input_placeholder": {
+        "UA": "Напишіть питання…",
+        "RU": "Напишите вопрос…",
+        "EN": "Type your question…",
+        "FR": "Écrivez votre question…",
+    },
+}
+
+
+def ui_text(key: str, lang: str) -> str:
+    texts = TRANSLATIONS[key]
+    return texts.get(lang) or texts["RU"]
+
+
 # GOLD answers (5 benchmarks) in four languages
 GOLD_5: Dict[str, Dict[str, str]] = {
     "RU": {
@@ -387,40 +544,42 @@ GOLD_5: Dict[str, Dict[str, str]] = {
     },
 }
 
+# (lang, key) -> answer, so the hot path does one lookup instead of two
+_GOLD_FLAT: Dict[Tuple[str, str], str] = {
+    (lang, key): ans for lang, answers in GOLD_5.items() for key, ans in answers.items()
+}
 
+
+def gold_answer(lang: str, key: str) -> Optional[str]:
+    return _GOLD_FLAT.get((lang, key))
+
+
+MENU_KEYS = ("what", "price", "payback", "terms", "contacts", "presentation", "lang")
+
+# one label per row, resolved once per language
+_MENU_ROWS: Dict[str, Tuple[Tuple[str], ...]] = {
+    lang: tuple((labels[key],) for key in MENU_KEYS) for lang, labels in MENU_LABELS.items()
+}
+
+
+@lru_cache(maxsize=8)
 def reply_menu(lang: str) -> ReplyKeyboardMarkup:
-    """Return the persistent reply keyboard for a given language."""
-    L = MENU_LABELS.get(lang, MENU_LABELS["RU"])
-    keyboard = [
-        [KeyboardButton(L["what"])],
-        [KeyboardButton(L["price"])],
-        [KeyboardButton(L["payback"])],
-        [KeyboardButton(L["terms"])],
-        [KeyboardButton(L["contacts"])],
-        [KeyboardButton(L["presentation"])],
-        [KeyboardButton(L["lang"])],
-    ]
+    """Return the persistent reply keyboard for a given language (built once per language)."""
+    rows = _MENU_ROWS.get(lang, _MENU_ROWS["RU"])
     return ReplyKeyboardMarkup(
-        keyboard=keyboard,
+        keyboard=[[KeyboardButton(label) for label in row] for row in rows],
         resize_keyboard=True,
-        one_time_keyboard=True,
-        input_field_placeholder={
-            "UA": "Напишіть питання…",
-            "RU": "Напишите вопрос…",
-            "EN": "Type your question…",
-            "FR": "Écrivez votre question…",
-        }.get(lang, "Напишите вопрос…"),
+        is_persistent=True,
+        input_field_placeholder=ui_text("input_placeholder", lang),
     )
 
 
-def lang_inline_keyboard() -> InlineKeyboardMarkup:
-    kb = [
-        [InlineKeyboardButton(LANG_LABELS["UA"], callback_data="LANG:UA"),
-         InlineKeyboardButton(LANG_LABELS["RU"], callback_data="LANG:RU")],
-        [InlineKeyboardButton(LANG_LABELS["EN"], callback_data="LANG:EN"),
-         InlineKeyboardButton(LANG_LABELS["FR"], callback_data="LANG:FR")],
-    ]
-    return InlineKeyboardMarkup(kb)
+LANG_INLINE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton(LANG_LABELS["UA"], callback_data="LANG:UA"),
+     InlineKeyboardButton(LANG_LABELS["RU"], callback_data="LANG:RU")],
+    [InlineKeyboardButton(LANG_LABELS["EN"], callback_data="LANG:EN"),
+     InlineKeyboardButton(LANG_LABELS["FR"], callback_data="LANG:FR")],
+])
 
 
 # =========================
@@ -436,11 +595,21 @@ BANNED_PATTERNS = [
     r"\broyalt",
     r"\bfranchise\s+fee",
 ]
+# One alternation -> one scan of the text instead of one search per pattern.
+# Stays on stdlib `re` on purpose: RE2's \b is ASCII-only, so with google-re2
+# `\bпаушальн` / `\bроялти\b` would silently stop matching Cyrillic text.
+# None of these patterns can backtrack catastrophically.
+_BANNED_RE = re.compile("|".join(f"(?:{p})" for p in BANNED_PATTERNS), re.IGNORECASE)
 
 
 def looks_like_legacy_franchise(text: str) -> bool:
-    t = (text or "").lower()
-    return any(re.search(p, t) for p in BANNED_PATTERNS)
+    return _BANNED_RE.search(text or "") is not None
+
+
+_WS_RE = re.compile(r"\s+")
+_ALNUM_RE = re.compile(r"[a-zA-Zа-яА-Я0-9]")
+_URL_RE = re.compile(r"https?://|www\.", re.IGNORECASE)
+_REPEAT_RE = re.compile(r"(.)\1{7,}")
 
 
 def is_spam_message(text: str) -> bool:
@@ -453,36 +622,40 @@ def is_spam_message(text: str) -> bool:
     if not text:
         return True
     # Remove whitespace
-    t = re.sub(r"\s+", "", text)
+    t = _WS_RE.sub("", text)
     # If there are no letters or digits, treat as spam
-    if not re.search(r"[a-zA-Zа-яА-Я0-9]", t):
+    if not _ALNUM_RE.search(t):
         return True
     # If contains http or www -> likely a link/spam
-    if "http://" in t.lower() or "https://" in t.lower() or "www." in t.lower():
+    if _URL_RE.search(t):
         return True
     # Detect long sequences of a single character (e.g. !!!!!!!!!! or haaaaaaaa)
-    if re.search(r"(.)\1{7,}", t):
+    if _REPEAT_RE.search(t):
         return True
     return False
 
 
-async def ensure_thread(user: UserState) -> str:
+async def ensure_thread(user_id: str) -> str:
+    user = get_user(user_id)
     if user.thread_id:
         return user.thread_id
-    thread = await asyncio.to_thread(client.beta.threads.create)
-    user.thread_id = thread.id
-    save_state()
-    return thread.id
-
-
-def _draft_instructions(lang: str, force_file_search: bool = False) -> str:
-    # <<< PATCH: force_file_search mode (2nd attempt)
-    force = ""
-    if force_file_search:
-        force = (
-            "ВАЖНО: перед тем как отвечать, ОБЯЗАТЕЛЬНО используй инструмент file_search минимум один раз. "
-            "Если в базе нет ответа — прямо скажи, что не можешь ответить корректно по базе, и попроси уточнение/выбор пункта меню. "
-        )
+    # Separate from get_user_lock() (callers may already hold that one):
+    # two concurrent first messages must not create two threads.
+    async with _lock_for(_thread_locks, user_id):
+        if user.thread_id:
+            return user.thread_id
+        thread = await get_client().beta.threads.create()
+        user.thread_id = thread.id
+        schedule_save()
+        return thread.id
+
+
+def _build_draft_instructions(lang: str) -> str:
+    # every run forces file_search (see _assistant_draft), so the prompt says so too
+    force = (
+        "ВАЖНО: перед тем как отвечать, ОБЯЗАТЕЛЬНО используй инструмент file_search минимум один раз. "
+        "Если в базе нет ответа — прямо скажи, что не можешь ответить корректно по базе, и попроси уточнение/выбор пункта меню. "
+    )
 
     if lang == "UA":
         return (
@@ -517,144 +690,168 @@ def _draft_instructions(lang: str, force_file_search: bool = False) -> str:
     )
 
 
+# assembled once per language instead of on every run
+_DRAFT_INSTRUCTIONS: Dict[str, str] = {lang: _build_draft_instructions(lang) for lang in LANGS}
+
+
+def _draft_instructions(lang: str) -> str:
+    return _DRAFT_INSTRUCTIONS.get(lang) or _DRAFT_INSTRUCTIONS["RU"]
+
+
+CUPS_RANGE = range(1, 201)  # plausible cups/day; `in` on a range is an O(1) bounds check
+
+# one pass classifies (cup keyword) and extracts (number) at the same time
+_CUPS_ROUTER_RE = re.compile(r"\b(?P<num>\d{1,3})\b|(?P<hint>чаш|cup|порций)", re.IGNORECASE)
+
+
 def _extract_cups_per_day(text: str) -> Optional[int]:
-    t = (text or "").lower()
-    if not any(w in t for w in ["чаш", "cup", "cups", "cups/day", "чашек", "порций"]):
-        return None
-    nums = re.findall(r"\b(\d{1,3})\b", t)
-    if not nums:
-        return None
-    for n in nums:
-        v = int(n)
-        if 1 <= v <= 200:
-            return v
+    cups: Optional[int] = None
+    hint = False
+    for m in _CUPS_ROUTER_RE.finditer(text or ""):
+        num = m.group("num")
+        if num is None:
+            hint = True
+        elif cups is None:
+            v = int(num)
+            if v in CUPS_RANGE:
+                cups = v
+        if hint and cups is not None:
+            return cups
     return None
 
 
+def _fmt_amount(x: float) -> str:
+    """Whole euros grouped like the GOLD texts ("1 890"). Amounts here stay far below 1 000 000."""
+    n = round(x)
+    if n < 1000:
+        return str(n)
+    return f"{n // 1000} {n % 1000:03d}"
+
+
+@lru_cache(maxsize=1024)
 def calc_profit_message(lang: str, cups_per_day: int) -> str:
     margin_per_cup = 1.8
     days = 30
     gross = cups_per_day * days * margin_per_cup
     net_low = gross - 600
     net_high = gross - 450
+    gross_s, low_s, high_s = _fmt_amount(gross), _fmt_amount(net_low), _fmt_amount(net_high)
 
     if lang == "EN":
         return (
             "Good question — let’s put numbers on it. "
             f"With about {cups_per_day} cups/day and an average margin of 1.8 € per cup, "
-            f"the gross margin is roughly {gross:,.0f} € per month. "
-            f"With typical monthly costs of 450–600 €, the net result is about {net_low:,.0f}–{net_high:,.0f} € per month."
+            f"the gross margin is roughly {gross_s} € per month. "
+            f"With typical monthly costs of 450–600 €, the net result is about {low_s}–{high_s} € per month."
         )
     if lang == "FR":
         return (
             "Bonne question — mettons des chiffres dessus. "
             f"Avec environ {cups_per_day} tasses/jour et une marge moyenne de 1,8 € par tasse, "
-            f"la marge brute est d’environ {gross:,.0f} € par mois. "
-            f"Avec des coûts mensuels typiques de 450–600 €, le résultat net est d’environ {net_low:,.0f}–{net_high:,.0f} € par mois."
+            f"la marge brute est d’environ {gross_s} € par mois. "
+            f"Avec des coûts mensuels typiques de 450–600 €, le résultat net est d’environ {low_s}–{high_s} € par mois."
         )
     if lang == "UA":
         return (
             "Хороший запит — давайте по цифрах. "
             f"За обсягу приблизно {cups_per_day} чашок/день і середньої маржі 1,8 € з чашки, "
-            f"валова маржа виходить близько {gross:,.0f} € на місяць. "
-            f"За типових витрат 450–600 € на місяць чистий результат — орієнтовно {net_low:,.0f}–{net_high:,.0f} € на місяць."
+            f"валова маржа виходить близько {gross_s} € на місяць. "
+            f"За типових витрат 450–600 € на місяць чистий результат — орієнтовно {low_s}–{high_s} € на місяць."
         )
     return (
         "Хороший вопрос — давайте по цифрам. "
         f"При объёме примерно {cups_per_day} чашек в день и средней марже 1,8 € с чашки "
-        f"валовая маржа выходит около {gross:,.0f} € в месяц. "
-        f"При типичных ежемесячных расходах 450–600 € чистый результат — ориентировочно {net_low:,.0f}–{net_high:,.0f} € в месяц."
+        f"валовая маржа выходит около {gross_s} € в месяц. "
+        f"При типичных ежемесячных расходах 450–600 € чистый результат — ориентировочно {low_s}–{high_s} € в месяц."
     )
 
 
-def _kb_only_fallback(lang: str) -> str:
-    if lang == "EN":
-        return "I can’t answer correctly from the knowledge base. Please choose a menu item or уточните вопрос."
-    if lang == "FR":
-        return "Je ne peux pas répondre correctement selon la base. Choisissez un пункт du menu ou уточните вопрос."
-    if lang == "UA":
-        return "Я не можу відповісти коректно по базі. Оберіть пункт меню або уточніть питання."
-    return "Я не могу ответить корректно по базе. Выберите пункт меню или уточните вопрос."
+def _prewarm_profit_messages() -> None:
+    """Warm the cache for the volumes people usually ask about."""
+    for lang in LANGS:
+        for cups in (20, 30, 35, 40, 50, 60, 80, 100):
+            calc_profit_message(lang=lang, cups_per_day=cups)
 
 
-async def _run_used_file_search(thread_id: str, run_id: str) -> bool:
-    """
-    Returns True if any run step contains a tool call of type 'file_search'.
-    """
-    try:
-        steps = await asyncio.to_thread(
-            client.beta.threads.runs.steps.list,
-            thread_id=thread_id,
-            run_id=run_id,
-            limit=50,
-        )
-        for st in getattr(steps, "data", []) or []:
-            details = getattr(st, "step_details", None)
-            if not details:
-                continue
-            # SDK objects may vary; we check robustly
-            # Common shape: details.type == "tool_calls" and details.tool_calls[*].type == "file_search"
-            d_type = getattr(details, "type", None) or getattr(details, "kind", None)
-            if d_type == "tool_calls":
-                tool_calls = getattr(details, "tool_calls", None) or []
-                for tc in tool_calls:
-                    tc_type = getattr(tc, "type", None) or getattr(tc, "tool", None)
-                    if tc_type == "file_search":
-                        return True
-                    # Sometimes nested: tc.file_search exists
-                    if getattr(tc, "file_search", None) is not None:
-                        return True
-        return False
-    except Exception as e:
-        log.warning("steps.list failed: %s", e)
-        return False
+_prewarm_profit_messages()
 
 
-async def _assistant_draft(user_id: str, user_text: str, lang: str, force_file_search: bool) -> Tuple[str, bool]:
+def _steps_used_file_search(steps) -> bool:
     """
-    Returns (answer_text, file_search_used)
+    Returns True if any run step contains a tool call of type 'file_search'.
     """
-    user = get_user(user_id)
-    thread_id = await ensure_thread(user)
+    for st in steps or []:
+        details = getattr(st, "step_details", None)
+        if not details:
+            continue
+        # SDK objects may vary; we check robustly
+        # Common shape: details.type == "tool_calls" and details.tool_calls[*].type == "file_search"
+        d_type = getattr(details, "type", None) or getattr(details, "kind", None)
+        if d_type == "tool_calls":
+            tool_calls = getattr(details, "tool_calls", None) or []
+            for tc in tool_calls:
+                tc_type = getattr(tc, "type", None) or getattr(tc, "tool", None)
+                if tc_type == "file_search":
+                    return True
+                # Sometimes nested: tc.file_search exists
+                if getattr(tc, "file_search", None) is not None:
+                    return True
+    return False
 
-    await asyncio.to_thread(
-        client.beta.threads.messages.create,
-        thread_id=thread_id,
-        role="user",
-        content=user_text,
-    )
 
-    run = await asyncio.to_thread(
-        client.beta.threads.runs.create,
-        thread_id=thread_id,
-        assistant_id=ASSISTANT_ID,
-        instructions=_draft_instructions(lang, force_file_search=force_file_search),
-    )
+RUN_TIMEOUT_SEC = 45
 
-    deadline = time.time() + 45
-    while time.time() < deadline:
-        rs = await asyncio.to_thread(client.beta.threads.runs.retrieve, thread_id=thread_id, run_id=run.id)
-        if rs.status in ("completed", "failed", "cancelled", "expired"):
-            run = rs
-            break
-        await asyncio.sleep(0.7)
 
-    if getattr(run, "status", "") != "completed":
-        return ("", False)
+async def _assistant_draft(user_id: str, user_text: str, lang: str) -> Tuple[str, bool]:
+    """
+    Returns (answer_text, file_search_used)
 
-    fs_used = await _run_used_file_search(thread_id=thread_id, run_id=run.id)
+    The run is streamed: completion, run steps and the reply message arrive as
+    server-sent events, so there is no status polling and no follow-up reads.
+    """
+    thread_id = await ensure_thread(user_id)
+    run_stream = None
 
-    msgs = await asyncio.to_thread(client.beta.threads.messages.list, thread_id=thread_id, limit=10)
-    for m in msgs.data:
-        if m.role == "assistant":
-            parts = []
-            for c in m.content:
-                if getattr(c, "type", None) == "text":
-                    parts.append(c.text.value)
-            ans = "\n".join(parts).strip()
-            return (ans or "", fs_used)
+    async def _stream_run() -> Tuple[str, bool]:
+        nonlocal run_stream
+        async with get_client().beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=ASSISTANT_ID,
+            instructions=_draft_instructions(lang),
+            # the user turn rides along with run creation (no separate messages.create)
+            additional_messages=[{"role": "user", "content": user_text}],
+            tool_choice={"type": "file_search"},
+        ) as stream:
+            run_stream = stream
+            await stream.until_done()
+            run = stream.current_run
+            if run is None or run.status != "completed":
+                return ("", False)
+            try:
+                fs_used = _steps_used_file_search(await stream.get_final_run_steps())
+                messages = await stream.get_final_messages()
+            except RuntimeError:  # the run emitted no steps / messages
+                return ("", False)
+
+        reply = messages[-1]
+        if reply.role != "assistant":
+            return ("", fs_used)
+        parts = [c.text.value for c in reply.content if getattr(c, "type", None) == "text"]
+        return ("\n".join(parts).strip(), fs_used)
 
-    return ("", fs_used)
+    try:
+        return await asyncio.wait_for(_stream_run(), timeout=RUN_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        log.warning("Assistant run timed out after %ss (thread %s)", RUN_TIMEOUT_SEC, thread_id)
+        # Dropping the stream does not stop the run server-side, and an active
+        # run locks the thread: the user's next message would fail until it expires.
+        run = run_stream.current_run if run_stream is not None else None
+        if run is not None:
+            try:
+                await get_client().beta.threads.runs.cancel(run.id, thread_id=thread_id)
+            except Exception as e:
+                log.warning("Cancelling run %s failed: %s", run.id, e)
+        return ("", False)
 
 
 async def ask_assistant(user_id: str, user_text: str, lang: str) -> str:
@@ -663,28 +860,66 @@ async def ask_assistant(user_id: str, user_text: str, lang: str) -> str:
     if cups is not None:
         return calc_profit_message(lang=lang, cups_per_day=cups)
 
-    # Run #1 (normal)
-    ans1, fs1 = await _assistant_draft(user_id=user_id, user_text=user_text, lang=lang, force_file_search=False)
-    if fs1 and ans1:
-        return ans1
+    # One run with file_search forced by the API; the KB-only gate still drops
+    # an answer if the run produced none or never actually searched.
+    ans, fs_used = await _assistant_draft(user_id=user_id, user_text=user_text, lang=lang)
+    if not (fs_used and ans):
+        # Hard fallback (KB-only rule)
+        return ui_text("kb_fallback", lang)
+    return ans
 
-    # Run #2 (FORCE file_search)
-    ans2, fs2 = await _assistant_draft(user_id=user_id, user_text=user_text, lang=lang, force_file_search=True)
-    if fs2 and ans2:
-        return ans2
 
-    # Hard fallback (KB-only rule)
-    return _kb_only_fallback(lang)
+# =========================
+# Transcript cache (bounded LRU)
+# =========================
+TRANSCRIPT_CACHE_SIZE = 256
+
+_transcript_cache: "OrderedDict[str, str]" = OrderedDict()
+
+
+async def transcribe_voice(context: ContextTypes.DEFAULT_TYPE, voice: Voice) -> str:
+    """
+    Speech-to-text for a Telegram voice message. Results are cached by
+    file_unique_id, so a re-sent/forwarded identical voice skips both the
+    download and the STT call.
+    """
+    key = voice.file_unique_id
+    cached = _transcript_cache.get(key)
+    if cached is not None:
+        _transcript_cache.move_to_end(key)
+        return cached
+
+    tg_file = await context.bot.get_file(voice.file_id)
+    # kept in memory: no temp file to write, reopen or clean up
+    data = await tg_file.download_as_bytearray()
+    tr = await get_client().audio.transcriptions.create(
+        model=TRANSCRIBE_MODEL,
+        file=("voice.ogg", bytes(data)),
+    )
+    transcript = (getattr(tr, "text", "") or "").strip()
+    if transcript:
+        _transcript_cache[key] = transcript
+        _transcript_cache.move_to_end(key)
+        if len(_transcript_cache) > TRANSCRIPT_CACHE_SIZE:
+            _transcript_cache.popitem(last=False)
+    return transcript
 
 
 # =========================
 # Typing indicator helper
 # =========================
+TYPING_REFRESH_SEC = 4.0  # Telegram shows "typing" for ~5 s per chat action
+
+
 async def _typing_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int, stop_event: asyncio.Event) -> None:
     try:
         while not stop_event.is_set():
             await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(3.5)
+            # wake up as soon as stop is set: callers await this task before replying
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=TYPING_REFRESH_SEC)
+            except asyncio.TimeoutError:
+                pass
     except Exception:
         pass
 
@@ -692,15 +927,16 @@ async def _typing_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int, stop_ev
 # =========================
 # Button text routing
 # =========================
+# label -> menu key, per language: routing a message is a single dict probe
+_LABEL_TO_KEY: Dict[str, Dict[str, str]] = {
+    lang: {labels[key]: key for key in MENU_KEYS} for lang, labels in MENU_LABELS.items()
+}
+
+
 def match_menu_action(lang: str, text: str) -> Optional[str]:
     if not text:
         return None
-    t = text.strip()
-    L = MENU_LABELS.get(lang, MENU_LABELS["RU"])
-    for key in ["what", "price", "payback", "terms", "contacts", "presentation", "lang"]:
-        if t == L[key]:
-            return key
-    return None
+    return _LABEL_TO_KEY.get(lang, _LABEL_TO_KEY["RU"]).get(text.strip())
 
 
 # =========================
@@ -709,14 +945,10 @@ def match_menu_action(lang: str, text: str) -> Optional[str]:
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(update.effective_user.id)
     u = get_user(user_id)
+    lang = u.lang
 
-    hello = {
-        "UA": "Привіт! Я Max, консультант Maison de Café. Оберіть пункт меню — і я підкажу по суті.",
-        "RU": "Привет! Я Max, консультант Maison de Café. Выберите пункт меню — и я подскажу по сути.",
-        "EN": "Hi! I’m Max, Maison de Café consultant. Choose a menu item and I’ll guide you.",
-        "FR": "Bonjour ! Je suis Max, consultant Maison de Café. Choisissez un пункт du menu et je vous guide.",
-    }.get(u.lang, "Привет! Я Max.")
-    await update.message.reply_text(hello, reply_markup=reply_menu(u.lang))
+    hello = ui_text("start", lang)
+    await update.message.reply_text(hello, reply_markup=reply_menu(lang))
 
 
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -743,9 +975,9 @@ async def on_lang_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     u = get_user(user_id)
     if lang in LANGS:
         u.lang = lang
-        save_state()
+        schedule_save()
 
-    confirm = {"UA": "Мову змінено.", "RU": "Язык изменён.", "EN": "Language updated.", "FR": "Langue mise à jour."}.get(u.lang, "OK")
+    confirm = ui_text("lang_changed", u.lang)
 
     # show reply keyboard again after language change
     await q.message.reply_text(confirm, reply_markup=reply_menu(u.lang))
@@ -754,27 +986,15 @@ async def on_lang_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def send_presentation(chat_id: int, lang: str, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send the presentation document or notify the user if missing, keeping the menu visible."""
     if not PRESENTATION_FILE_ID:
-        msg = {
-            "UA": "Гарне запитання. Презентація ще не підключена — додамо файл і я одразу зможу її надіслати.",
-            "RU": "Хороший вопрос. Презентация ещё не подключена — добавим файл и я сразу смогу её отправить.",
-            "EN": "Good question. The presentation isn’t connected yet — once the file is added, I can send it right away.",
-            "FR": "Bonne question. La présentation n’est pas encore connectée — dès que le fichier est ajouté, je peux l’envoyer.",
-        }.get(lang, "Презентация ещё не подключена.")
+        msg = ui_text("presentation_missing", lang)
         await context.bot.send_message(chat_id=chat_id, text=msg, reply_markup=reply_menu(lang))
         return
 
     try:
-        await context.bot.send_document(chat_id=chat_id, document=PRESENTATION_FILE_ID)
-        # After sending the document, send a blank message to re-display the menu
-        await context.bot.send_message(chat_id=chat_id, text=" ", reply_markup=reply_menu(lang))
+        await context.bot.send_document(chat_id=chat_id, document=PRESENTATION_FILE_ID, reply_markup=reply_menu(lang))
     except Exception as e:
         log.warning("Presentation send failed: %s", e)
-        msg = {
-            "UA": "Гарне запитання. Не зміг відправити презентацію в цьому чаті. Напишіть — і я надішлю іншим способом.",
-            "RU": "Хороший вопрос. Не получилось отправить презентацию в этом чате. Напишите — и я пришлю другим способом.",
-            "EN": "Good question. I couldn’t send the presentation here. Message me and I’ll share it another way.",
-            "FR": "Bonne question. Je n’arrive pas à envoyer la présentation ici. Écrivez-moi et je la partagerai autrement.",
-        }.get(lang, "Не получилось отправить презентацию.")
+        msg = ui_text("presentation_failed", lang)
         await context.bot.send_message(chat_id=chat_id, text=msg, reply_markup=reply_menu(lang))
 
 
@@ -784,6 +1004,8 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     u = get_user(user_id)
+    lang = u.lang
+    chat_id = update.effective_chat.id
     text = (update.message.text or "").strip()
     if not text:
         return
@@ -791,54 +1013,49 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     async with get_user_lock(user_id):
         # Spam filter: handle obviously junk messages politely
         if is_spam_message(text):
-            polite = {
-                "UA": "Вибачте, не зрозумів запит. Оберіть пункт меню або поставте уточнювальне питання.",
-                "RU": "Извините, не понял запрос. Выберите пункт меню или уточните вопрос.",
-                "EN": "Sorry, I didn’t understand. Please choose a menu item or clarify.",
-                "FR": "Désolé, je n’ai pas compris. Choisissez un élément du menu ou clarifiez."
-            }.get(u.lang, "Извините, не понял запрос.")
-            await update.message.reply_text(polite, reply_markup=reply_menu(u.lang))
+            polite = ui_text("spam_reply", lang)
+            await update.message.reply_text(polite, reply_markup=reply_menu(lang))
             return
 
-        action = match_menu_action(u.lang, text)
+        action = match_menu_action(lang, text)
 
         if action == "lang":
-            prompt = {"UA": "Оберіть мову:", "RU": "Выберите язык:", "EN": "Choose language:", "FR": "Choisissez la langue:"}.get(u.lang, "Выберите язык:")
-            await update.message.reply_text(prompt, reply_markup=lang_inline_keyboard())
+            prompt = ui_text("lang_prompt", lang)
+            await update.message.reply_text(prompt, reply_markup=LANG_INLINE_KB)
             return
 
         if action == "presentation":
-            await send_presentation(chat_id=update.effective_chat.id, lang=u.lang, context=context)
+            await send_presentation(chat_id=chat_id, lang=lang, context=context)
             return
 
         # Pre‑defined answers for menu actions
         if action in ("what", "price", "payback", "terms", "contacts"):
-            if action in GOLD_5.get(u.lang, {}):
+            ans = gold_answer(lang, action)
+            if ans:
                 # Use deterministic answer and redisplay menu
-                ans = GOLD_5[u.lang][action]
-                await update.message.reply_text(ans, reply_markup=reply_menu(u.lang))
+                await update.message.reply_text(ans, reply_markup=reply_menu(lang))
             else:
                 # Fallback to assistant for languages without gold answers
                 stop = asyncio.Event()
-                typing_task = asyncio.create_task(_typing_loop(context, update.effective_chat.id, stop))
+                typing_task = asyncio.create_task(_typing_loop(context, chat_id, stop))
                 try:
-                    ans = await ask_assistant(user_id=user_id, user_text=text, lang=u.lang)
+                    ans = await ask_assistant(user_id=user_id, user_text=text, lang=lang)
                 finally:
                     stop.set()
                     await typing_task
-                await update.message.reply_text(ans, reply_markup=reply_menu(u.lang))
+                await update.message.reply_text(ans, reply_markup=reply_menu(lang))
             return
 
         # Free text -> KB-only gate pipeline
         stop = asyncio.Event()
-        typing_task = asyncio.create_task(_typing_loop(context, update.effective_chat.id, stop))
+        typing_task = asyncio.create_task(_typing_loop(context, chat_id, stop))
         try:
-            ans = await ask_assistant(user_id=user_id, user_text=text, lang=u.lang)
+            ans = await ask_assistant(user_id=user_id, user_text=text, lang=lang)
         finally:
             stop.set()
             await typing_task
 
-        await update.message.reply_text(ans, reply_markup=reply_menu(u.lang))
+        await update.message.reply_text(ans, reply_markup=reply_menu(lang))
 
 
 async def on_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -846,54 +1063,84 @@ async def on_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if user_id in _blocked:
         return
     u = get_user(user_id)
+    lang = u.lang
+    chat_id = update.effective_chat.id
 
     async with get_user_lock(user_id):
         stop = asyncio.Event()
-        typing_task = asyncio.create_task(_typing_loop(context, update.effective_chat.id, stop))
+        typing_task = asyncio.create_task(_typing_loop(context, chat_id, stop))
         try:
             voice = update.message.voice
             if not voice:
                 return
 
-            tg_file = await context.bot.get_file(voice.file_id)
-            ogg_path = f"/tmp/voice_{user_id}_{int(time.time())}.ogg"
-            await tg_file.download_to_drive(ogg_path)
-
-            with open(ogg_path, "rb") as f:
-                tr = await asyncio.to_thread(
-                    client.audio.transcriptions.create,
-                    model=TRANSCRIBE_MODEL,
-                    file=f,
-                )
-            transcript = (getattr(tr, "text", "") or "").strip()
+            # acknowledge right away; the ack goes out while the voice is downloaded and transcribed
+            ack = asyncio.create_task(update.message.reply_text(ui_text("voice_ack", lang)))
+            transcript, ack_res = await asyncio.gather(
+                transcribe_voice(context, voice), ack, return_exceptions=True
+            )
+            if isinstance(ack_res, Exception):
+                log.warning("voice ack failed: %s", ack_res)
+            if isinstance(transcript, BaseException):
+                raise transcript
 
             if not transcript:
-                msg = {
-                    "UA": "Гарне запитання. Не зміг розпізнати голос. Спробуйте ще раз коротше й чіткіше.",
-                    "RU": "Хороший вопрос. Не смог распознать голос. Попробуйте ещё раз короче и чётче.",
-                    "EN": "Good question. I couldn’t transcribe the voice message. Please try again, shorter and clearer.",
-                    "FR": "Bonne question. Je n’ai pas pu transcrire le message vocal. Réessayez plus court et plus clair.",
-                }.get(u.lang, "Не смог распознать голос.")
-                await update.message.reply_text(msg, reply_markup=reply_menu(u.lang))
+                msg = ui_text("voice_failed", lang)
+                await update.message.reply_text(msg, reply_markup=reply_menu(lang))
                 return
 
-            ans = await ask_assistant(user_id=user_id, user_text=transcript, lang=u.lang)
-            await update.message.reply_text(ans, reply_markup=reply_menu(u.lang))
+            ans = await ask_assistant(user_id=user_id, user_text=transcript, lang=lang)
+            await update.message.reply_text(ans, reply_markup=reply_menu(lang))
         finally:
             stop.set()
             await typing_task
 
 
 async def post_init(app: Application) -> None:
-    try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        log.info("Webhook cleared (drop_pending_updates=True)")
-    except Exception as e:
-        log.warning("delete_webhook failed: %s", e)
+    # in webhook mode run_webhook() registers the webhook right after this hook
+    if not WEBHOOK_URL:
+        try:
+            await app.bot.delete_webhook(drop_pending_updates=True)
+            log.info("Webhook cleared (drop_pending_updates=True)")
+        except Exception as e:
+            log.warning("delete_webhook failed: %s", e)
+
+    global _state_writer_task
+    _state_writer_task = asyncio.create_task(state_writer())
+
+
+async def post_shutdown(app: Application) -> None:
+    if _state_writer_task is not None:
+        _state_writer_task.cancel()
+        try:
+            await _state_writer_task
+        except asyncio.CancelledError:
+            pass
+    # flush whatever is still pending from the last debounce window
+    if _save_requested.is_set():
+        save_state()
+        log.info("State flushed on shutdown")
+    if _client is not None:
+        await _client.close()
 
 
 def build_app() -> Application:
-    return ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    # Updates from different users are handled concurrently, so their assistant
+    # runs overlap on the shared AsyncOpenAI connection pool instead of queueing
+    # behind each other. Per-user ordering is kept by get_user_lock().
+    # PTB's defaults already fit this: a 256-connection pool for Bot API calls
+    # (one per concurrent update) and a separate one for getUpdates.
+    return (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        # throttles every outbound Bot API call to Telegram's limits (30 msg/s
+        # overall, 20 msg/min per group) and retries once on a 429 RetryAfter
+        .rate_limiter(AIORateLimiter(max_retries=1))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
 
 def main() -> None:
@@ -910,7 +1157,20 @@ def main() -> None:
     app.add_handler(MessageHandler(filters.VOICE, on_voice))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    if WEBHOOK_URL:
+        # Telegram pushes updates as they arrive; no getUpdates long-poll loop
+        log.info("Starting in webhook mode on port %s", WEBHOOK_PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path="telegram",
+            webhook_url=f"{WEBHOOK_URL}/telegram",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 
 
 if __name__ == "__main__":